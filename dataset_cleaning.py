@@ -9,17 +9,43 @@ Example:
   photo.png + photo.jpg → photo_png.png + photo_jpg.jpg
   (Associated caption files like photo.txt are also renamed accordingly)
 
+With --near-duplicates, resized or re-encoded copies of the same image are
+found via perceptual hashing instead. In each group the highest-resolution
+image is kept and the others are moved into a '_duplicates' subfolder
+(together with their caption files). Hashes are cached per folder in the
+user cache directory, so only new or changed images are hashed on re-runs.
+
 Usage:
   python dataset_cleaning.py <folder_path> [--dry-run]
+  python dataset_cleaning.py <folder_path> --near-duplicates [--threshold N] [--workers N] [--dry-run]
 """
 
 import os
 import sys
+import json
+import time
+import hashlib
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
+from itertools import combinations
+from math import comb
+from concurrent.futures import ProcessPoolExecutor
 
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tiff', '.tif'}
 CAPTION_EXTENSIONS = {'.txt', '.caption'}
+LOSSLESS_EXTENSIONS = {'.png', '.tif', '.tiff', '.bmp', '.webp'}
+
+HASH_BITS = 64
+HASH_CACHE_DIR = os.path.join('comfyui-text-templates', 'near-duplicates')
+HASH_CACHE_FLUSH_SECONDS = 60
+# Bucket lookups + hash comparisons above which the search gets slow (~1 min)
+SEARCH_COST_WARNING = 1e8
+DUPLICATES_DIR = '_duplicates'
+# Hashes with this few bits set (or unset) come from flat or near-flat images,
+# which all hash alike regardless of content
+LOW_DETAIL_BITS = 4
+# Max per-channel difference in mean colour (0-255) between duplicates
+MAX_COLOUR_DIFF = 24
 
 
 def find_conflicts(folder_path):
@@ -78,7 +104,7 @@ def rename_conflicting_files(folder_path, dry_run=False):
             old_path = os.path.join(folder_path, filename)
             new_name = get_new_name(filename)
             new_path = os.path.join(folder_path, new_name)
-            renames.append((old_path, new_path, filename, new_name))
+            renames.append([(old_path, new_path, filename, new_name)])
 
         # Check for associated caption files (these would be ambiguous)
         captions = find_associated_files(folder_path, base_name)
@@ -86,28 +112,409 @@ def rename_conflicting_files(folder_path, dry_run=False):
             print(f"    ⚠ Associated caption file(s) found: {captions}")
             print(f"      These will need manual review - unclear which image they belong to")
 
-    print(f"\nPlanned renames ({len(renames)} files):\n")
-    for old_path, new_path, old_name, new_name in renames:
-        print(f"  {old_name} → {new_name}")
+    execute_renames(renames, dry_run=dry_run)
+
+
+def execute_renames(renames, dry_run=False):
+    """
+    Print planned renames and perform them unless this is a dry run.
+
+    renames is a list of units, each a list of (old_path, new_path, old_name,
+    new_name). A unit (e.g. an image and its captions) is renamed all or nothing.
+    """
+    print(f"\nPlanned renames ({sum(len(unit) for unit in renames)} files):\n")
+    for unit in renames:
+        for old_path, new_path, old_name, new_name in unit:
+            print(f"  {old_name} → {new_name}")
 
     if dry_run:
         print("\n[DRY RUN] No files were modified.")
         return
 
     print("\nExecuting renames...")
-    for old_path, new_path, old_name, new_name in renames:
-        if os.path.exists(new_path):
-            print(f"  ✗ Skipped {old_name}: target '{new_name}' already exists")
+    for unit in renames:
+        existing = [new_name for _, new_path, _, new_name in unit if os.path.exists(new_path)]
+        if existing:
+            names = ', '.join(old_name for _, _, old_name, _ in unit)
+            print(f"  ✗ Skipped {names}: target '{existing[0]}' already exists")
             continue
-        os.rename(old_path, new_path)
-        print(f"  ✓ {old_name} → {new_name}")
+        for old_path, new_path, old_name, new_name in unit:
+            os.rename(old_path, new_path)
+            print(f"  ✓ {old_name} → {new_name}")
 
     print("\nDone!")
 
 
+def compute_dhash(filepath):
+    """
+    Compute a 64-bit difference hash and the mean colour of an image.
+
+    Returns (hash, width, height, (r, g, b)), or None if the file can't be
+    decoded. Runs in worker processes, so it must stay a top-level function.
+    """
+    from PIL import Image, ImageStat
+
+    try:
+        with Image.open(filepath) as img:
+            width, height = img.size
+            # Let the decoder downscale (JPEG DCT scaling) instead of decoding full size
+            img.draft('RGB', (64, 64))
+            img = img.convert('RGB').resize((9, 8), Image.BILINEAR)
+            colour = tuple(round(c) for c in ImageStat.Stat(img).mean)
+            pixels = img.convert('L').tobytes()
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value, width, height, colour
+
+
+def hash_cache_path(folder_path):
+    """
+    Cache file for a dataset folder. It lives in the user cache directory
+    (XDG_CACHE_HOME or ~/.cache), not the dataset, so dry runs can fill it.
+    """
+    cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    folder_id = hashlib.sha1(os.path.realpath(folder_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_root, HASH_CACHE_DIR, folder_id + '.json')
+
+
+def _valid_cache_entry(entry):
+    """Check an entry is [mtime_ns, size, hash_hex, width, height, colour_hex] (or unreadable)."""
+    if not isinstance(entry, list) or len(entry) != 6:
+        return False
+    mtime_ns, size, value, width, height, colour = entry
+    if not all(isinstance(n, int) for n in (mtime_ns, size, width, height)):
+        return False
+    if value is None:
+        return colour is None
+    try:
+        return len(value) == 16 and len(bytes.fromhex(colour)) == 3 and int(value, 16) >= 0
+    except (TypeError, ValueError):
+        return False
+
+
+def load_hash_cache(folder_path):
+    """Load cached hashes, keyed by filename. Malformed entries are dropped."""
+    cache_path = hash_cache_path(folder_path)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {name: entry for name, entry in cache.items() if _valid_cache_entry(entry)}
+
+
+def save_hash_cache(folder_path, cache):
+    """Write the hash cache atomically so an interrupted run can't corrupt it."""
+    cache_path = hash_cache_path(folder_path)
+    tmp_path = cache_path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"  ⚠ Could not write hash cache: {e}")
+
+
+def hash_images(folder_path, workers=None):
+    """
+    Hash every image in the folder, reusing cached hashes for files whose
+    mtime and size are unchanged. The cache is only rewritten when it changed.
+
+    Returns a dict of filename -> (hash, width, height, file_size, colour).
+    """
+    entries = {}
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in IMAGE_EXTENSIONS:
+                st = entry.stat()
+                entries[entry.name] = (st.st_mtime_ns, st.st_size)
+
+    cache = load_hash_cache(folder_path)
+    results = {}
+    new_cache = {}
+    pending = []
+    unreadable = []
+
+    for filename, (mtime_ns, size) in entries.items():
+        cached = cache.get(filename)
+        if cached and cached[0] == mtime_ns and cached[1] == size:
+            new_cache[filename] = cached
+            if cached[2] is None:
+                unreadable.append(filename)
+            else:
+                colour = tuple(bytes.fromhex(cached[5]))
+                results[filename] = (int(cached[2], 16), cached[3], cached[4], size, colour)
+        else:
+            pending.append(filename)
+
+    print(f"Hashing {len(pending)} image(s) ({len(entries) - len(pending)} cached)...")
+    for filename in unreadable:
+        print(f"  ⚠ Could not read {filename} (cached)")
+
+    saved = cache
+    last_flush = time.monotonic()
+    try:
+        if pending:
+            paths = [os.path.join(folder_path, f) for f in pending]
+            chunksize = max(1, min(256, len(paths) // ((workers or os.cpu_count() or 1) * 4)))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                hashed = executor.map(compute_dhash, paths, chunksize=chunksize)
+                for filename, result in zip(pending, hashed):
+                    mtime_ns, size = entries[filename]
+                    if result is None:
+                        print(f"  ⚠ Could not read {filename}")
+                        new_cache[filename] = [mtime_ns, size, None, 0, 0, None]
+                    else:
+                        value, width, height, colour = result
+                        results[filename] = (value, width, height, size, colour)
+                        new_cache[filename] = [
+                            mtime_ns, size, f"{value:016x}", width, height, bytes(colour).hex()
+                        ]
+
+                    # Flush periodically so an interrupted run keeps its progress
+                    if time.monotonic() - last_flush > HASH_CACHE_FLUSH_SECONDS:
+                        save_hash_cache(folder_path, new_cache)
+                        saved = dict(new_cache)
+                        last_flush = time.monotonic()
+    finally:
+        if new_cache != saved:
+            save_hash_cache(folder_path, new_cache)
+    return results
+
+
+def hamming_distance(a, b):
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+
+def is_low_detail(value):
+    """True for hashes of flat or near-flat images, which can't be told apart."""
+    bits = bin(value).count('1')
+    return bits <= LOW_DETAIL_BITS or bits >= HASH_BITS - LOW_DETAIL_BITS
+
+
+def colours_match(a, b):
+    """True if two mean colours are close enough for a duplicate."""
+    return all(abs(x - y) <= MAX_COLOUR_DIFF for x, y in zip(a, b))
+
+
+def _choose_segment_count(item_count, threshold):
+    """
+    Pick how many segments to split hashes into for the multi-index search.
+
+    More segments mean narrower keys (crowded buckets) but a smaller search
+    radius per segment (fewer probes). Estimate the cost of each option,
+    assuming uniformly spread hashes, and keep the cheapest.
+    """
+    best_count, best_cost = threshold + 1, None
+    for count in range(1, min(threshold + 1, HASH_BITS) + 1):
+        width = -(-HASH_BITS // count)
+        radius = threshold // count
+        probes = sum(comb(width, k) for k in range(radius + 1))
+        cost = item_count * count * probes * (1 + item_count / 2 ** width)
+        if best_cost is None or cost < best_cost:
+            best_count, best_cost = count, cost
+    return best_count
+
+
+def find_near_duplicate_groups(hashes, threshold):
+    """
+    Group hashes whose Hamming distance is <= threshold. Matches are
+    chained, so a group holds every hash connected through such pairs.
+
+    Uses a multi-index hash table: the hash is split into m segments, and by
+    the pigeonhole principle any two hashes within the threshold differ by at
+    most threshold // m bits in at least one segment. Each hash only probes
+    the buckets within that radius of its own segments, avoiding an O(n²) scan.
+
+    hashes: dict of key -> int hash. Returns a list of lists of keys.
+    """
+    segment_count = _choose_segment_count(len(hashes), threshold)
+    radius = threshold // segment_count
+    bounds = [HASH_BITS * i // segment_count for i in range(segment_count + 1)]
+
+    segments = []
+    for i in range(segment_count):
+        width = bounds[i + 1] - bounds[i]
+        flips = [
+            sum(1 << bit for bit in bits)
+            for k in range(radius + 1)
+            for bits in combinations(range(width), k)
+        ]
+        segments.append((bounds[i], (1 << width) - 1, flips))
+
+    tables = [defaultdict(list) for _ in segments]
+    keys = list(hashes)
+    values = [hashes[key] for key in keys]
+
+    # Real hashes cluster (e.g. similar shots), so estimate the cost from the
+    # actual bucket occupancy: every pair sharing a bucket gets compared
+    probes = len(segments[0][2])
+    occupancy = [Counter((value >> shift) & mask for value in values) for shift, mask, _ in segments]
+    largest_bucket = max((max(c.values(), default=0) for c in occupancy), default=0)
+    cost = len(values) * segment_count * probes + sum(n * n for c in occupancy for n in c.values())
+    if cost > SEARCH_COST_WARNING:
+        print(f"  ⚠ Near-duplicate search will be slow for {len(values)} images at threshold "
+              f"{threshold}: {segment_count} segments x {probes} probes each, largest bucket "
+              f"holds {largest_bucket} images (~{cost:.1e} operations). "
+              f"Lower --threshold for a faster search.")
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for index, value in enumerate(values):
+        checked = set()
+        for table, (shift, mask, flips) in zip(tables, segments):
+            segment = (value >> shift) & mask
+            for flip in flips:
+                bucket = table.get(segment ^ flip)
+                if not bucket:
+                    continue
+                for other in bucket:
+                    if other in checked:
+                        continue
+                    checked.add(other)
+                    if hamming_distance(value, values[other]) <= threshold:
+                        root_a, root_b = find(index), find(other)
+                        if root_a != root_b:
+                            parent[root_a] = root_b
+            table[segment].append(index)
+
+    groups = defaultdict(list)
+    for index, key in enumerate(keys):
+        groups[find(index)].append(key)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def move_near_duplicates(folder_path, threshold=5, workers=None, dry_run=False):
+    """Move near-duplicate images (and their captions) into a subfolder."""
+    images = hash_images(folder_path, workers=workers)
+
+    low_detail = sorted(name for name, info in images.items() if is_low_detail(info[0]))
+    if low_detail:
+        shown = ', '.join(low_detail[:10]) + (', ...' if len(low_detail) > 10 else '')
+        print(f"  ⚠ Skipped {len(low_detail)} low-detail image(s) (flat or nearly flat, "
+              f"can't be compared reliably): {shown}")
+
+    groups = find_near_duplicate_groups(
+        {name: info[0] for name, info in images.items() if not is_low_detail(info[0])},
+        threshold,
+    )
+
+    if not groups:
+        print("No near-duplicate images found.")
+        return
+
+    # Keep the largest image of each group; ties go to lossless formats
+    # (a bigger lossy re-encode isn't better), then the bigger file, then the name
+    def keep_priority(filename):
+        _, width, height, size, _ = images[filename]
+        lossless = os.path.splitext(filename)[1].lower() in LOSSLESS_EXTENSIONS
+        return (-width * height, not lossless, -size, filename)
+
+    image_bases = defaultdict(int)
+    for filename in images:
+        image_bases[os.path.splitext(filename)[0]] += 1
+
+    def is_duplicate(keep, filename):
+        return (
+            hamming_distance(images[keep][0], images[filename][0]) <= threshold
+            and colours_match(images[keep][4], images[filename][4])
+        )
+
+    # Groups are chained, so members can be further than the threshold from
+    # the kept image. Only move those within it; regroup the rest around the
+    # next best image.
+    plan = []
+    for group in groups:
+        remaining = sorted(group, key=keep_priority)
+        while len(remaining) > 1:
+            keep = remaining[0]
+            duplicates, rest = [], []
+            for filename in remaining[1:]:
+                (duplicates if is_duplicate(keep, filename) else rest).append(filename)
+            if duplicates:
+                plan.append((keep, duplicates))
+            remaining = rest
+
+    if not plan:
+        print("No near-duplicate images found.")
+        return
+
+    print(f"\nFound {len(plan)} group(s) of near-duplicates:\n")
+
+    renames = []
+    dup_dir = os.path.join(folder_path, DUPLICATES_DIR)
+    planned_targets = set()
+
+    def target_base(base, names):
+        """Pick a base name whose targets clash with nothing already in or headed for dup_dir."""
+        candidate, n = base, 0
+        while any(
+            candidate + ext in planned_targets or os.path.exists(os.path.join(dup_dir, candidate + ext))
+            for ext in (os.path.splitext(name)[1] for name in names)
+        ):
+            n += 1
+            candidate = f"{base}_{n}"
+        return candidate
+
+    for keep, duplicates in sorted(plan):
+        print(f"  Keeping '{keep}' ({images[keep][1]}x{images[keep][2]}):")
+        for filename in duplicates:
+            _, width, height, _, _ = images[filename]
+            distance = hamming_distance(images[keep][0], images[filename][0])
+            print(f"    - {filename} ({width}x{height}, distance {distance})")
+
+            moved = [filename]
+            base = os.path.splitext(filename)[0]
+            captions = find_associated_files(folder_path, base)
+            if captions and image_bases[base] > 1:
+                print(f"    ⚠ Caption file(s) {captions} shared by several images - left in place")
+            else:
+                moved.extend(captions)
+
+            # Keep the image and its captions together under one free base name
+            new_base = target_base(base, moved)
+            unit = []
+            for name in moved:
+                target = new_base + os.path.splitext(name)[1]
+                planned_targets.add(target)
+                unit.append((
+                    os.path.join(folder_path, name),
+                    os.path.join(dup_dir, target),
+                    name,
+                    os.path.join(DUPLICATES_DIR, target),
+                ))
+            renames.append(unit)
+
+    if not dry_run:
+        os.makedirs(dup_dir, exist_ok=True)
+
+    execute_renames(renames, dry_run=dry_run)
+
+
 def main():
     parser = argparse.ArgumentParser(
-        description="Rename image files with conflicting base names in a dataset folder."
+        description="Rename image files with conflicting base names in a dataset folder, "
+                    "or with --near-duplicates, move resized/re-encoded copies of the same "
+                    f"image into a '{DUPLICATES_DIR}' subfolder."
     )
     parser.add_argument("folder", help="Path to the dataset folder")
     parser.add_argument(
@@ -115,6 +522,26 @@ def main():
         action="store_true",
         help="Show what would be renamed without actually renaming"
     )
+    parser.add_argument(
+        "--near-duplicates",
+        action="store_true",
+        help=f"Find resized/re-encoded copies via perceptual hashing and move them to "
+             f"'{DUPLICATES_DIR}'. Hashes are cached under ~/.cache/{HASH_CACHE_DIR.replace(os.sep, '/')}, "
+             f"so a dry run speeds up the real run"
+    )
+    parser.add_argument(
+        "--threshold", "-t",
+        type=int,
+        default=5,
+        help="Max Hamming distance (0-63) between hashes to count as a near-duplicate "
+             "(default: 5). On large folders, search time grows quickly from 8 upwards"
+    )
+    parser.add_argument(
+        "--workers", "-j",
+        type=int,
+        default=None,
+        help="Number of hashing processes (default: CPU count)"
+    )
 
     args = parser.parse_args()
 
@@ -122,7 +549,26 @@ def main():
         print(f"Error: '{args.folder}' is not a valid directory")
         sys.exit(1)
 
-    rename_conflicting_files(args.folder, dry_run=args.dry_run)
+    if args.near_duplicates:
+        if not 0 <= args.threshold < HASH_BITS:
+            print(f"Error: --threshold must be between 0 and {HASH_BITS - 1}")
+            sys.exit(1)
+        if args.workers is not None and args.workers < 1:
+            print("Error: --workers must be at least 1")
+            sys.exit(1)
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            print("Error: --near-duplicates requires Pillow (pip install Pillow)")
+            sys.exit(1)
+        move_near_duplicates(
+            args.folder,
+            threshold=args.threshold,
+            workers=args.workers,
+            dry_run=args.dry_run,
+        )
+    else:
+        rename_conflicting_files(args.folder, dry_run=args.dry_run)
 
 
 if __name__ == "__main__":
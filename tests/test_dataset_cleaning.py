@@ -0,0 +1,126 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dataset_cleaning  # noqa: E402
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+
+@pytest.fixture(autouse=True)
+def _isolated_cache(tmp_path_factory, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path_factory.mktemp('cache')))
+
+
+def _patterned_image(size=(256, 192)):
+    img = Image.new('RGB', size, (40, 90, 160))
+    draw = ImageDraw.Draw(img)
+    w, h = size
+    draw.rectangle((w * 0.1, h * 0.2, w * 0.45, h * 0.9), fill=(230, 200, 60))
+    draw.ellipse((w * 0.5, h * 0.05, w * 0.95, h * 0.6), fill=(200, 40, 40))
+    draw.rectangle((w * 0.55, h * 0.7, w * 0.9, h * 0.95), fill=(20, 20, 20))
+    return img
+
+
+def test_solid_colour_images_are_not_duplicates(tmp_path):
+    Image.new('RGB', (128, 128), (255, 255, 255)).save(tmp_path / 'white.png')
+    Image.new('RGB', (128, 128), (0, 0, 0)).save(tmp_path / 'black.jpg')
+    Image.new('RGB', (128, 128), (0, 0, 255)).save(tmp_path / 'blue.jpg')
+
+    dataset_cleaning.move_near_duplicates(str(tmp_path), workers=1)
+
+    assert sorted(p.name for p in tmp_path.iterdir() if p.suffix in ('.png', '.jpg')) == [
+        'black.jpg', 'blue.jpg', 'white.png',
+    ]
+    assert not (tmp_path / dataset_cleaning.DUPLICATES_DIR).exists()
+
+
+def test_resized_copy_is_moved_with_caption(tmp_path):
+    original = _patterned_image()
+    original.save(tmp_path / 'photo.png')
+    original.resize((128, 96)).save(tmp_path / 'photo_small.jpg', quality=70)
+    (tmp_path / 'photo_small.txt').write_text('caption')
+
+    dataset_cleaning.move_near_duplicates(str(tmp_path), workers=1)
+
+    dup_dir = tmp_path / dataset_cleaning.DUPLICATES_DIR
+    assert (tmp_path / 'photo.png').exists()
+    assert (dup_dir / 'photo_small.jpg').exists()
+    assert (dup_dir / 'photo_small.txt').exists()
+
+
+def test_chained_matches_beyond_threshold_stay(tmp_path, monkeypatch):
+    base = (1 << 32) - 1
+    hashes = {
+        'a.png': base,
+        'b.png': base ^ 0b11111,
+        'c.png': base ^ ((1 << 10) - 1),
+        'd.png': base ^ ((1 << 15) - 1),
+    }
+    for name in hashes:
+        (tmp_path / name).write_bytes(b'')
+    images = {
+        name: (value, 100 - i, 100 - i, 10, (128, 128, 128))
+        for i, (name, value) in enumerate(hashes.items())
+    }
+    monkeypatch.setattr(dataset_cleaning, 'hash_images', lambda *args, **kwargs: images)
+
+    dataset_cleaning.move_near_duplicates(str(tmp_path), threshold=5)
+
+    # a keeps b; c is regrouped and keeps d; nothing moves further than 5 bits
+    dup_dir = tmp_path / dataset_cleaning.DUPLICATES_DIR
+    assert sorted(p.name for p in dup_dir.iterdir()) == ['b.png', 'd.png']
+
+
+def test_rerun_keeps_image_and_caption_together(tmp_path):
+    original = _patterned_image()
+    original.save(tmp_path / 'photo.png')
+    original.resize((128, 96)).save(tmp_path / 'photo_small.jpg', quality=70)
+    (tmp_path / 'photo_small.txt').write_text('new caption')
+    dup_dir = tmp_path / dataset_cleaning.DUPLICATES_DIR
+    dup_dir.mkdir()
+    (dup_dir / 'photo_small.jpg').write_bytes(b'earlier run')
+
+    dataset_cleaning.move_near_duplicates(str(tmp_path), workers=1)
+
+    assert (dup_dir / 'photo_small.jpg').read_bytes() == b'earlier run'
+    assert (dup_dir / 'photo_small_1.jpg').exists()
+    assert (dup_dir / 'photo_small_1.txt').read_text() == 'new caption'
+    assert not (tmp_path / 'photo_small.jpg').exists()
+    assert not (tmp_path / 'photo_small.txt').exists()
+
+
+def test_hash_cache_written_only_when_changed(tmp_path, monkeypatch):
+    saves = []
+    save = dataset_cleaning.save_hash_cache
+    monkeypatch.setattr(dataset_cleaning, 'save_hash_cache',
+                        lambda *args: saves.append(args) or save(*args))
+
+    dataset_cleaning.hash_images(str(tmp_path), workers=1)
+    assert saves == []
+    assert not os.path.exists(dataset_cleaning.hash_cache_path(str(tmp_path)))
+
+    _patterned_image().save(tmp_path / 'photo.png')
+    dataset_cleaning.hash_images(str(tmp_path), workers=1)
+    assert len(saves) == 1
+    assert os.listdir(tmp_path) == ['photo.png']
+
+    dataset_cleaning.hash_images(str(tmp_path), workers=1)
+    assert len(saves) == 1
+
+
+@pytest.mark.parametrize('content', ['[1, 2, 3]', '{"photo.png": [1, 2]}', '{"photo.png": "x"}', 'not json'])
+def test_malformed_hash_cache_is_ignored(tmp_path, content):
+    _patterned_image().save(tmp_path / 'photo.png')
+    cache_path = dataset_cleaning.hash_cache_path(str(tmp_path))
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, 'w') as f:
+        f.write(content)
+
+    images = dataset_cleaning.hash_images(str(tmp_path), workers=1)
+
+    assert list(images) == ['photo.png']